@@ -1,47 +1,135 @@
 import os
+import asyncio
 import sqlite3
+import base64
+import codecs
+import hashlib
+import html
 import json
+import logging
 import re
+import queue
+import threading
+import time
 import datetime as dt
-from typing import Dict, Any, Optional
+import functools
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import (
+    Dict,
+    Any,
+    AsyncIterator,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
-from fastapi import FastAPI, Request, HTTPException
+import msgspec
+import orjson
+from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import (
+    Response,
     HTMLResponse,
     JSONResponse,
     RedirectResponse,
     PlainTextResponse,
+    StreamingResponse,
 )
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
 
 # --- Optional Gmail imports ---
 try:
     from google.oauth2.credentials import Credentials
     from google_auth_oauthlib.flow import Flow
-    from googleapiclient.discovery import build
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.discovery_cache import get_static_doc
     from google.auth.transport.requests import Request as GoogleRequest
+    from googleapiclient.errors import HttpError
+    from google_auth_httplib2 import AuthorizedHttp
+    import httplib2
 
     HAS_GMAIL = True
 except Exception:
     HAS_GMAIL = False
 
+# --- Optional memcached (shared OAuth state across workers) ---
+try:
+    from pymemcache.client.base import PooledClient as MemcacheClient
+except ImportError:
+    MemcacheClient = None
+
 # ---------------- CONFIG ----------------
 
+logger = logging.getLogger(__name__)
+
 DB_PATH = "expense_app.db"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "25"))
+DB_POOL_OVERFLOW = int(os.getenv("DB_POOL_OVERFLOW", "25"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+SCHEMA_VERSION = 1
 BASE_URL = os.getenv("BASE_URL", "http://127.0.0.1:8000")
 GMAIL_SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
+GMAIL_REDIRECT_URI = f"{BASE_URL}/api/gmail/callback"
+GMAIL_BATCH_SIZE = 100  # Gmail's per-batch request limit
+GMAIL_LIST_PAGE_SIZE = 500  # Gmail's maxResults cap for list calls
+GMAIL_INSERT_CHUNK = 500  # synced rows written per transaction
+GMAIL_HTTP_TIMEOUT = 60
+GMAIL_HTTP_POOL_SIZE = 4  # idle Gmail HTTP clients kept between syncs
+GMAIL_NUM_RETRIES = 5  # googleapiclient backs off on 429/5xx
+# full messages per page above which body parsing moves to worker processes
+GMAIL_PARSE_PROCESS_MIN = 64
 
 AMOUNT_REGEX = re.compile(
     r"(?:₹|INR|Rs\.?)\s*([0-9][0-9,]*(?:\.[0-9]{1,2})?)",
     re.IGNORECASE,
 )
 
-# state -> Flow (for OAuth)
-OAUTH_FLOWS: Dict[str, "Flow"] = {}
+# Gmail search terms that mark a message as a likely transaction
+GMAIL_QUERY_PHRASES = (
+    "payment successful",
+    "payment of Rs",
+    "debited",
+    "order placed",
+    "invoice",
+)
+GMAIL_QUERY = "(%s)" % " OR ".join('"%s"' % p for p in GMAIL_QUERY_PHRASES)
+# slack when searching for mail since the previous sync (late delivery, skew)
+GMAIL_SINCE_MARGIN = 24 * 3600
+
+# subjects worth downloading the full body for when no amount was found
+RECEIPT_SUBJECT_REGEX = re.compile(
+    r"receipt|order|invoice|payment|charged|debited", re.IGNORECASE
+)
+
+OAUTH_STATE_TTL = 600  # seconds a started OAuth flow stays valid
+OAUTH_STATE_MAX = 1024
+# "host:port"; when set, OAuth state and the client config cache live in
+# memcached so a callback may land on a different worker than its start
+MEMCACHED_SERVER = os.getenv("MEMCACHED_SERVER")
 
 # ---------------- FASTAPI APP & DB ----------------
 
-app = FastAPI(title="One-Page Expense + Todo App", version="1.0.0")
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson (faster, emits bytes directly)."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
+app = FastAPI(
+    title="One-Page Expense + Todo App",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -49,155 +137,391 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# the dashboard HTML and /api/state JSON compress well; tiny bodies aren't
+# worth it, and gzip would hold back the streamed sync progress lines
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=512,
+    exclude_content_types=DEFAULT_EXCLUDED_CONTENT_TYPES + ("application/x-ndjson",),
+)
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that keeps one reusable cursor per named statement."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stmt_cursors: Dict[str, sqlite3.Cursor] = {}
+
+    def stmt_cursor(self, name: str) -> sqlite3.Cursor:
+        cur = self._stmt_cursors.get(name)
+        if cur is None:
+            cur = self._stmt_cursors[name] = self.cursor()
+        return cur
+
+
+class SQLiteConnectionPool:
+    """Long-lived SQLite connections shared across requests.
+
+    ``size`` connections are opened up front and kept. Under bursts up to
+    ``max_overflow`` extra connections are opened on demand and closed again
+    when returned. Once both are exhausted, a checkout waits ``timeout``
+    seconds for a connection to come back before giving up.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        size: int = DB_POOL_SIZE,
+        max_overflow: int = DB_POOL_OVERFLOW,
+        timeout: float = DB_POOL_TIMEOUT,
+    ):
+        self.path = path
+        self.timeout = timeout
+        self._overflow_left = max_overflow
+        self._lock = threading.Lock()
+        self._conns: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._conns.put(self._connect())
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+            factory=PooledConnection,
+        )
+        # paid once per pooled connection, not per request
+        conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=268435456;
+            PRAGMA cache_size=-65536;
+            PRAGMA foreign_keys=ON;
+            """
+        )
+        return conn
 
+    def checkout(self) -> sqlite3.Connection:
+        try:
+            return self._conns.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            use_overflow = self._overflow_left > 0
+            if use_overflow:
+                self._overflow_left -= 1
+        if use_overflow:
+            try:
+                return self._connect()
+            except BaseException:
+                with self._lock:
+                    self._overflow_left += 1
+                raise
+        try:
+            return self._conns.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError("no database connection available") from None
+
+    def checkin(self, conn: sqlite3.Connection):
+        # never hand a half-finished transaction to the next request
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._conns.put_nowait(conn)
+        except queue.Full:
+            # pool already holds ``size`` idle connections: drop the extra one
+            conn.close()
+            with self._lock:
+                self._overflow_left += 1
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    def close(self):
+        while True:
+            try:
+                conn = self._conns.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
 
 
-def init_db():
-    conn = get_db()
-    conn.executescript(
-        """
-        CREATE TABLE IF NOT EXISTS expenses (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            source TEXT NOT NULL,               -- 'gmail','sms','manual'
-            date TEXT NOT NULL,                 -- 'YYYY-MM-DD'
-            merchant TEXT,
-            description TEXT,
-            amount REAL NOT NULL,
-            raw TEXT,
-            created_at TEXT NOT NULL DEFAULT (datetime('now'))
-        );
-
-        CREATE TABLE IF NOT EXISTS todos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            text TEXT NOT NULL,
-            done INTEGER NOT NULL DEFAULT 0,
-            created_at TEXT NOT NULL DEFAULT (datetime('now'))
-        );
-
-        CREATE TABLE IF NOT EXISTS settings (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        );
-        """
+db_pool: Optional[SQLiteConnectionPool] = None
+
+
+def get_db_dep() -> Iterator[sqlite3.Connection]:
+    try:
+        conn = db_pool.checkout()
+    except TimeoutError:
+        raise HTTPException(503, "Database busy, try again.")
+    try:
+        yield conn
+    finally:
+        db_pool.checkin(conn)
+
+
+@contextmanager
+def transaction(conn) -> Iterator[sqlite3.Connection]:
+    """Group several statements into one explicit transaction (one fsync).
+
+    Nested use joins the transaction that is already open.
+    """
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+SCHEMA_STATEMENTS = (
+    """
+    CREATE TABLE IF NOT EXISTS expenses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,               -- 'gmail','sms','manual'
+        date TEXT NOT NULL,                 -- 'YYYY-MM-DD'
+        merchant TEXT,
+        description TEXT,
+        amount REAL NOT NULL,
+        raw TEXT,
+        created_at TEXT NOT NULL DEFAULT (datetime('now')),
+        gmail_msg_id TEXT                   -- Gmail message id, if any
     )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS todos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        done INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL DEFAULT (datetime('now'))
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_expenses_date_id
+        ON expenses(date DESC, id DESC)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_expenses_source_date
+        ON expenses(source, date DESC)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_todos_done_created
+        ON todos(done, created_at DESC)
+    """,
+)
+
+
+def init_db(conn):
+    # the DDL below only has to run once per database file
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+    # one worker migrates at a time (executescript would commit early, so
+    # statements run one by one inside the lock)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # another worker may have finished while we waited for the lock
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            conn.rollback()
+            return
+        for statement in SCHEMA_STATEMENTS:
+            conn.execute(statement)
+        # databases created before gmail_msg_id existed
+        columns = {r[1] for r in conn.execute("PRAGMA table_info(expenses)")}
+        if "gmail_msg_id" not in columns:
+            conn.execute("ALTER TABLE expenses ADD COLUMN gmail_msg_id TEXT")
+        conn.execute(
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS ux_expenses_gmail
+                ON expenses(gmail_msg_id) WHERE gmail_msg_id IS NOT NULL
+            """
+        )
+        conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+    except BaseException:
+        conn.rollback()
+        raise
     conn.commit()
-    conn.close()
 
 
 @app.on_event("startup")
 def on_startup():
-    init_db()
+    global db_pool
+    db_pool = SQLiteConnectionPool(DB_PATH)
+    with db_pool.connection() as conn:
+        init_db(conn)
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    if db_pool is not None:
+        db_pool.close()
+    shutdown_gmail_pools()
 
 # ---------------- SETTINGS HELPERS ----------------
 
 
 def get_setting(conn, key: str, default: Optional[str] = None) -> Optional[str]:
-    row = conn.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
-    return row["value"] if row else default
+    row = (
+        conn.stmt_cursor("get_setting")
+        .execute("SELECT value FROM settings WHERE key=?", (key,))
+        .fetchone()
+    )
+    return row[0] if row else default
 
 
-def set_setting(conn, key: str, value: str):
-    conn.execute(
+def get_settings(conn, keys: Tuple[str, ...]) -> Dict[str, str]:
+    """Read several settings in one round trip. Missing keys are absent."""
+    rows = conn.execute(
+        "SELECT key, value FROM settings WHERE key IN (%s)" % ",".join("?" * len(keys)),
+        keys,
+    )
+    return dict(rows.fetchall())
+
+
+def set_setting(conn, key: str, value: str, commit: bool = True):
+    conn.stmt_cursor("set_setting").execute(
         "INSERT OR REPLACE INTO settings(key,value) VALUES(?,?)",
         (key, value),
     )
-    conn.commit()
+    if commit:
+        conn.commit()
 
 # ---------------- EXPENSE HELPERS ----------------
 
+EXPENSE_INSERT_SQL = """
+    INSERT INTO expenses (source,date,merchant,description,amount,raw)
+    VALUES (?,?,?,?,?,?)
+"""
 
-def store_expense(
-    conn,
-    source: str,
-    date: str,
-    merchant: str,
-    description: str,
-    amount: float,
-    raw: str = "",
-):
-    conn.execute(
+
+def store_expenses(conn, rows: list):
+    """Insert many (source,date,merchant,description,amount,raw) rows at once."""
+    with transaction(conn):
+        conn.executemany(EXPENSE_INSERT_SQL, rows)
+
+
+GMAIL_EXPENSE_INSERT_SQL = """
+    INSERT OR IGNORE INTO expenses
+        (source,date,merchant,description,amount,raw,gmail_msg_id)
+    VALUES (?,?,?,?,?,?,?)
+"""
+
+
+def store_gmail_expenses(conn, rows: list) -> int:
+    """Insert synced Gmail rows, skipping message ids already stored.
+
+    Returns the number of rows actually inserted.
+    """
+    with transaction(conn):
+        cur = conn.executemany(GMAIL_EXPENSE_INSERT_SQL, rows)
+    return cur.rowcount
+
+
+def known_gmail_ids(conn, ids: list) -> set:
+    """Which of ``ids`` are already stored, in one indexed probe."""
+    if not ids:
+        return set()
+    rows = conn.execute(
         """
-        INSERT INTO expenses (source,date,merchant,description,amount,raw)
-        VALUES (?,?,?,?,?,?)
+        SELECT gmail_msg_id FROM expenses
+        WHERE gmail_msg_id IN (SELECT value FROM json_each(?))
         """,
-        (source, date, merchant, description, amount, raw),
+        # one JSON text parameter: constant SQL, no host-parameter limit
+        (orjson.dumps(ids).decode(),),
     )
-    conn.commit()
+    return {r[0] for r in rows}
 
 
-def parse_amount(text: str) -> Optional[float]:
-    matches = [m.group(1) for m in AMOUNT_REGEX.finditer(text or "")]
-    if not matches:
-        return None
-    nums = []
-    for m in matches:
-        try:
-            nums.append(float(m.replace(",", "")))
-        except ValueError:
-            continue
-    return max(nums) if nums else None
+def parse_amount(*texts: str) -> Optional[float]:
+    """Largest amount found across ``texts``, scanned without joining them."""
+    best = None
+    for text in texts:
+        for m in AMOUNT_REGEX.findall(text or ""):
+            try:
+                value = float(m.replace(",", ""))
+            except ValueError:
+                continue
+            if best is None or value > best:
+                best = value
+    return best
+
+
+@functools.lru_cache(maxsize=None)
+def _summary_statements(by_date: bool, by_source: bool) -> Tuple[str, str, str, str]:
+    """SQL for the (date filter x source filter) shapes, built once each.
+
+    Stable statement text also lets sqlite3's per-connection statement cache
+    reuse the compiled plans across requests.
+    """
+    clauses = []
+    if by_date:
+        clauses.append("date >= ?")
+    if by_source:
+        clauses.append("source = ?")
+    where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+    return (
+        "SELECT COALESCE(SUM(amount), 0) FROM expenses" + where,
+        "SELECT substr(date, 1, 7) AS month, SUM(amount) FROM expenses"
+        + where
+        + " GROUP BY month",
+        "SELECT date, SUM(amount) FROM expenses" + where + " GROUP BY date",
+        "SELECT id, source, date, merchant, description, amount FROM expenses"
+        + where
+        + " ORDER BY date DESC, id DESC",
+    )
 
 
 def summarize_expenses(
     conn, days: int = 60, source: str = "all"
 ) -> Dict[str, Any]:
-    params = []
-    query = "SELECT date, amount, source, merchant, description FROM expenses WHERE 1=1"
-
+    params: Tuple[str, ...] = ()
     if days > 0:
-        start_date = (dt.date.today() - dt.timedelta(days=days - 1)).isoformat()
-        query += " AND date >= ?"
-        params.append(start_date)
-
+        params += ((dt.date.today() - dt.timedelta(days=days - 1)).isoformat(),)
     if source != "all":
-        query += " AND source = ?"
-        params.append(source)
-
-    rows = conn.execute(query, params).fetchall()
-
-    total = 0.0
-    by_month: Dict[str, float] = {}
-    by_day: Dict[str, float] = {}
+        params += (source,)
+    total_sql, month_sql, day_sql, list_sql = _summary_statements(
+        days > 0, source != "all"
+    )
 
-    for r in rows:
-        amount = float(r["amount"])
-        total += amount
-        month_key = r["date"][:7]
-        by_month[month_key] = by_month.get(month_key, 0.0) + amount
-        by_day[r["date"]] = by_day.get(r["date"], 0.0) + amount
+    # aggregates are computed by SQLite, streaming through the indexes
+    total = conn.execute(total_sql, params).fetchone()[0]
+    by_month = dict(conn.execute(month_sql, params).fetchall())
+    by_day = dict(conn.execute(day_sql, params).fetchall())
 
     # full list for UI
-    rows_full = conn.execute(
-        """
-        SELECT id, source, date, merchant, description, amount
-        FROM expenses
-        WHERE 1=1
-        """
-        + (" AND date >= ?" if days > 0 else "")
-        + ("" if source == "all" else " AND source = ?")
-        + " ORDER BY date DESC, id DESC",
-        params,
-    ).fetchall()
-
     expenses_list = [
-        dict(
-            id=r["id"],
-            source=r["source"],
-            date=r["date"],
-            merchant=r["merchant"] or "",
-            description=r["description"] or "",
-            amount=float(r["amount"]),
+        {
+            "id": id_,
+            "source": src,
+            "date": date,
+            "merchant": merchant or "",
+            "description": description or "",
+            "amount": float(amount),
+        }
+        for id_, src, date, merchant, description, amount in conn.execute(
+            list_sql, params
         )
-        for r in rows_full
     ]
 
     return {
-        "total": total,
+        "total": float(total),
         "by_month": by_month,
         "by_day": by_day,
         "expenses": expenses_list,
@@ -238,52 +562,489 @@ def build_insights(summary: Dict[str, Any]) -> list:
 
 
 def get_todos(conn):
-    rows = conn.execute(
+    cur = conn.execute(
         "SELECT id,text,done,created_at FROM todos ORDER BY done, created_at DESC"
-    ).fetchall()
-    return [dict(r) for r in rows]
+    )
+    return [
+        {"id": id_, "text": text, "done": done, "created_at": created_at}
+        for id_, text, done, created_at in cur
+    ]
+
+
+def add_todo(conn, text: str):
+    conn.execute("INSERT INTO todos(text) VALUES (?)", (text,))
+    conn.commit()
+
+
+def toggle_todo(conn, todo_id: int) -> bool:
+    """Flip a todo's done flag. Returns False if the todo does not exist."""
+    cur = conn.execute(
+        "UPDATE todos SET done = CASE WHEN done THEN 0 ELSE 1 END WHERE id=?",
+        (todo_id,),
+    )
+    conn.commit()
+    return cur.rowcount > 0
+
+
+def delete_todo(conn, todo_id: int):
+    conn.execute("DELETE FROM todos WHERE id=?", (todo_id,))
+    conn.commit()
+
+# ---------------- OAUTH STATE ----------------
+
+
+class TTLStore:
+    """Thread-safe mapping whose entries expire after ``ttl`` seconds.
+
+    At most ``maxsize`` entries are kept (oldest evicted first), so abandoned
+    OAuth redirects cannot grow memory without bound.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            now = time.monotonic()
+            self._cleanup(now)
+            self._items.pop(key, None)
+            self._items[key] = (now + self.ttl, value)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            item = self._items.pop(key, None)
+        if item is None or item[0] <= time.monotonic():
+            return default
+        return item[1]
+
+    def _cleanup(self, now: float):
+        # fixed ttl: insertion order is expiry order
+        while self._items:
+            expires, _ = next(iter(self._items.values()))
+            if expires > now:
+                break
+            self._items.popitem(last=False)
+
+
+class MemcachedStore:
+    """TTLStore-compatible store kept in memcached and shared by all workers.
+
+    Values must be JSON-serialisable. ``ttl=0`` keeps entries until evicted.
+    """
+
+    def __init__(self, server: str, prefix: str, ttl: int):
+        if MemcacheClient is None:
+            raise RuntimeError("MEMCACHED_SERVER is set but pymemcache is not installed")
+        self.ttl = ttl
+        self._client = MemcacheClient(
+            server,
+            serde=_JSONSerde(),
+            key_prefix=prefix.encode(),
+            connect_timeout=2,
+            timeout=2,
+        )
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._client.get(key, default)
+
+    def set(self, key: str, value: Any):
+        self._client.set(key, value, expire=self.ttl)
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        value = self._client.get(key, default)
+        self._client.delete(key)
+        return value
+
+
+class _JSONSerde:
+    def serialize(self, key, value):
+        return orjson.dumps(value), 1
+
+    def deserialize(self, key, value, flags):
+        return orjson.loads(value)
+
+
+# state -> {"redirect_uri", "code_verifier"} (for OAuth); plain data rather
+# than the Flow so it can be shared between workers
+if MEMCACHED_SERVER:
+    OAUTH_STATES = MemcachedStore(MEMCACHED_SERVER, "oauth:", OAUTH_STATE_TTL)
+    SHARED_SETTINGS = MemcachedStore(MEMCACHED_SERVER, "setting:", 0)
+else:
+    OAUTH_STATES = TTLStore(maxsize=OAUTH_STATE_MAX, ttl=OAUTH_STATE_TTL)
+    SHARED_SETTINGS = None
 
 # ---------------- GMAIL HELPERS ----------------
 
 
+# (raw setting, parsed dict) of the last client config seen by this process;
+# the config only changes when it is re-saved through the settings API
+_client_config_cache: Optional[Tuple[str, Optional[Dict[str, Any]]]] = None
+
+
 def get_gmail_client_config(conn) -> Optional[Dict[str, Any]]:
-    raw = get_setting(conn, "gmail_client_config")
-    if not raw:
-        return None
+    if SHARED_SETTINGS is not None:
+        # another worker may have re-saved it: the raw value comes from
+        # memcached, only the parse is cached in-process
+        raw = SHARED_SETTINGS.get("gmail_client_config")
+        if raw is None:
+            raw = get_setting(conn, "gmail_client_config") or ""
+            SHARED_SETTINGS.set("gmail_client_config", raw)
+        return parse_gmail_client_config(raw)
+    if _client_config_cache is not None:
+        return _client_config_cache[1]
+    return parse_gmail_client_config(get_setting(conn, "gmail_client_config"))
+
+
+def parse_gmail_client_config(raw: Optional[str]) -> Optional[Dict[str, Any]]:
+    global _client_config_cache
+    raw = raw or ""
+    if _client_config_cache is not None and _client_config_cache[0] == raw:
+        return _client_config_cache[1]
     try:
-        return json.loads(raw)
-    except json.JSONDecodeError:
-        return None
+        cfg = orjson.loads(raw) if raw else None
+    except orjson.JSONDecodeError:
+        cfg = None
+    _client_config_cache = (raw, cfg)
+    return cfg
+
+
+def set_gmail_client_config(conn, cfg: Optional[Dict[str, Any]]):
+    global _client_config_cache
+    raw = orjson.dumps(cfg).decode() if cfg else ""
+    set_setting(conn, "gmail_client_config", raw)
+    _client_config_cache = (raw, cfg or None)
+    if SHARED_SETTINGS is not None:
+        SHARED_SETTINGS.set("gmail_client_config", raw)
+
+
+# one refresh at a time; the app stores a single Gmail account
+_gmail_refresh_lock = threading.Lock()
+
+# (raw token, credentials built from it); reused while the stored token
+# is unchanged, replaced whenever it is re-saved or refreshed
+_gmail_creds_cache: Optional[Tuple[str, "Credentials"]] = None
+_gmail_creds_lock = threading.Lock()
+
+
+def _credentials_for_token(raw: str) -> "Credentials":
+    global _gmail_creds_cache
+    with _gmail_creds_lock:
+        if _gmail_creds_cache is not None and _gmail_creds_cache[0] == raw:
+            return _gmail_creds_cache[1]
+        creds = Credentials.from_authorized_user_info(
+            orjson.loads(raw), scopes=GMAIL_SCOPES
+        )
+        _gmail_creds_cache = (raw, creds)
+        return creds
 
 
-def get_gmail_credentials(conn) -> Optional["Credentials"]:
-    if not HAS_GMAIL:
-        return None
-    raw = get_setting(conn, "gmail_token")
-    if not raw:
+def gmail_credentials_from_token(conn, raw: Optional[str]) -> Optional["Credentials"]:
+    """Build (and refresh if expired) credentials from a stored token JSON.
+
+    The token is written back only when a refresh actually changed it.
+    """
+    global _gmail_creds_cache
+    if not HAS_GMAIL or not raw:
         return None
-    info = json.loads(raw)
-    creds = Credentials.from_authorized_user_info(info, scopes=GMAIL_SCOPES)
+    creds = _credentials_for_token(raw)
     if creds.expired and creds.refresh_token:
-        creds.refresh(GoogleRequest())
-        set_setting(conn, "gmail_token", creds.to_json())
+        with _gmail_refresh_lock:
+            # a concurrent request may have refreshed while we waited
+            latest = get_setting(conn, "gmail_token")
+            if latest and latest != raw:
+                raw = latest
+                creds = _credentials_for_token(raw)
+            if creds.expired and creds.refresh_token:
+                creds.refresh(GoogleRequest())
+                refreshed = creds.to_json()
+                if refreshed != raw:
+                    set_setting(conn, "gmail_token", refreshed)
+                with _gmail_creds_lock:
+                    _gmail_creds_cache = (refreshed, creds)
     return creds
 
 
-def sync_gmail_expenses(conn, creds: "Credentials", days: int = 60) -> int:
-    """Fetch recent Gmail messages and insert as expenses. Returns new count."""
-    service = build("gmail", "v1", credentials=creds)
-    query = (
-        f"newer_than:{days}d "
-        '("payment successful" OR "payment of Rs" OR "debited" OR "order placed" OR "invoice")'
+def gmail_body_data(payload: Dict[str, Any]) -> Optional[str]:
+    """Base64 data of the first text/plain part (or the single-part body)."""
+    if "parts" in payload:
+        for part in payload["parts"]:
+            if part.get("mimeType") == "text/plain":
+                data = part.get("body", {}).get("data")
+                if data:
+                    return data
+        return None
+    return payload.get("body", {}).get("data")
+
+
+def max_amount_in_base64(
+    data: str, window: int = 4096, overlap: int = 64
+) -> Optional[float]:
+    """Largest amount in a base64url body, decoded window by window.
+
+    Only ``window`` bytes are decoded at a time. The last ``overlap``
+    characters are carried into the next window so an amount split across a
+    boundary is still matched whole.
+    """
+    raw = data.encode("ascii")
+    step = window // 3 * 4  # base64 chars per window, multiple of 4
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    carry = ""
+    best = None
+    for start in range(0, len(raw), step):
+        final = start + step >= len(raw)
+        text = carry + decoder.decode(
+            base64.urlsafe_b64decode(raw[start : start + step]), final
+        )
+        # a match running into the overlap may continue in the next window
+        limit = len(text) if final else len(text) - overlap
+        for m in AMOUNT_REGEX.finditer(text):
+            if m.end() > limit:
+                break
+            try:
+                value = float(m.group(1).replace(",", ""))
+            except ValueError:
+                continue
+            if best is None or value > best:
+                best = value
+        carry = text[-2 * overlap :]
+    return best
+
+
+def fetch_gmail_messages(
+    service,
+    user_id: str,
+    ids: list,
+    metadata_only: bool = False,
+    skip_missing: bool = False,
+) -> list:
+    """Fetch messages for ``ids`` using Gmail's batch endpoint.
+
+    With ``metadata_only`` only the Subject/From/Date headers and the snippet
+    are downloaded instead of the full MIME body. With ``skip_missing``
+    messages deleted since their id was listed (404) are left out instead
+    of raising.
+
+    Ids are sent GMAIL_BATCH_SIZE per HTTP round trip. Sub-requests that
+    fail inside a batch are retried once as individual gets.
+    """
+    fetched: Dict[str, Dict[str, Any]] = {}
+    failed = []
+
+    def on_message(request_id, response, exception):
+        if exception is not None:
+            failed.append(request_id)
+        else:
+            fetched[request_id] = response
+
+    if metadata_only:
+        params = {"format": "metadata", "metadataHeaders": ["Subject", "From", "Date"]}
+    else:
+        params = {"format": "full"}
+
+    def get_request(msg_id):
+        return service.users().messages().get(userId=user_id, id=msg_id, **params)
+
+    for start in range(0, len(ids), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_message)
+        for msg_id in ids[start : start + GMAIL_BATCH_SIZE]:
+            batch.add(get_request(msg_id), request_id=msg_id)
+        batch.execute()
+
+    for msg_id in failed:
+        try:
+            fetched[msg_id] = get_request(msg_id).execute(
+                num_retries=GMAIL_NUM_RETRIES
+            )
+        except HttpError as e:
+            if not (skip_missing and e.resp.status == 404):
+                raise
+    return [fetched[msg_id] for msg_id in ids if msg_id in fetched]
+
+
+# idle httplib2 clients, kept open between syncs for their TLS connections
+_gmail_http_idle: "queue.LifoQueue" = queue.LifoQueue(maxsize=GMAIL_HTTP_POOL_SIZE)
+
+
+@contextmanager
+def gmail_http(creds: "Credentials") -> Iterator["AuthorizedHttp"]:
+    """Authorized transport over a pooled httplib2 client held for the block."""
+    try:
+        http = _gmail_http_idle.get_nowait()
+    except queue.Empty:
+        http = httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT)
+    try:
+        yield AuthorizedHttp(creds, http=http)
+    finally:
+        try:
+            _gmail_http_idle.put_nowait(http)
+        except queue.Full:
+            http.close()
+
+
+@functools.lru_cache(maxsize=None)
+def gmail_discovery_doc() -> Dict[str, Any]:
+    """Gmail v1 discovery document bundled with googleapiclient, parsed once."""
+    doc = orjson.loads(get_static_doc("gmail", "v1"))
+    # building a resource fills in its method descriptions; do it once here
+    # so concurrent syncs sharing the dict never modify it
+    _warm_gmail_resources(build_from_document(doc, http=httplib2.Http()), doc)
+    return doc
+
+
+def _warm_gmail_resources(resource, desc: Dict[str, Any]):
+    for name, sub in desc.get("resources", {}).items():
+        _warm_gmail_resources(getattr(resource, name)(), sub)
+
+
+GMAIL_HEADERS = frozenset(("subject", "from", "date"))
+
+
+def gmail_headers(payload: Dict[str, Any]) -> Dict[str, str]:
+    """Lower-cased Subject/From/Date headers; the first occurrence wins."""
+    wanted: Dict[str, str] = {}
+    for h in payload.get("headers", []):
+        name = h["name"].lower()
+        if name in GMAIL_HEADERS and name not in wanted:
+            wanted[name] = h["value"]
+    return wanted
+
+
+def parse_gmail_message(full: Dict[str, Any]) -> Optional[tuple]:
+    """Expense row for a fetched Gmail message, or None if it has no amount.
+
+    Works on metadata-only messages too; the body is then simply absent.
+    """
+    payload = full.get("payload", {})
+    wanted = gmail_headers(payload)
+    subject = wanted.get("subject", "")
+    from_ = wanted.get("from", "")
+    date_raw = wanted.get("date", "")
+
+    # parse date
+    try:
+        dt_obj = parsedate_to_datetime(date_raw)
+        date_str = dt_obj.date().isoformat()
+    except Exception:
+        date_str = dt.date.today().isoformat()
+
+    # transactional subjects (or Gmail's ~200 char snippet) usually
+    # carry the amount already; only decode the body when they don't
+    amount = parse_amount(subject)
+    if amount is None:
+        amount = parse_amount(full.get("snippet", ""))
+    if amount is None:
+        data = gmail_body_data(payload)
+        if data:
+            amount = max_amount_in_base64(data)
+    if amount is None:
+        return None
+
+    merchant = from_.split("<")[0].strip() or from_
+    description = subject
+    raw = orjson.dumps({"subject": subject, "from": from_})[:1000].decode(
+        "utf-8", errors="ignore"
     )
-    user_id = "me"
-    next_page_token = None
-    added = 0
+    return ("gmail", date_str, merchant, description, amount, raw, full["id"])
+
+
+_parse_pool: Optional[ProcessPoolExecutor] = None
+_prefetch_pool: Optional[ThreadPoolExecutor] = None
+_gmail_pools_lock = threading.Lock()
 
-    import base64
-    from email.utils import parsedate_to_datetime
 
+def gmail_parse_pool() -> ProcessPoolExecutor:
+    """Process pool for body parsing, started on first use and kept."""
+    global _parse_pool
+    with _gmail_pools_lock:
+        if _parse_pool is None:
+            # spawn, not fork: the server process has threads (and locks)
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _parse_pool
+
+
+def gmail_prefetch_pool() -> ThreadPoolExecutor:
+    """Threads that list the next Gmail page during a sync."""
+    global _prefetch_pool
+    with _gmail_pools_lock:
+        if _prefetch_pool is None:
+            _prefetch_pool = ThreadPoolExecutor(
+                max_workers=2, thread_name_prefix="gmail-list"
+            )
+        return _prefetch_pool
+
+
+def shutdown_gmail_pools():
+    global _parse_pool, _prefetch_pool
+    with _gmail_pools_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown(cancel_futures=True)
+            _parse_pool = None
+        if _prefetch_pool is not None:
+            _prefetch_pool.shutdown(cancel_futures=True)
+            _prefetch_pool = None
+
+
+def parse_gmail_messages(messages: list) -> List[Optional[tuple]]:
+    """parse_gmail_message over ``messages``, in order.
+
+    Base64 decoding and regex scans of bodies are CPU-bound, so large
+    batches are spread over worker processes; small ones aren't worth the
+    pickling.
+    """
+    if len(messages) < GMAIL_PARSE_PROCESS_MIN:
+        return [parse_gmail_message(m) for m in messages]
+    return list(gmail_parse_pool().map(parse_gmail_message, messages, chunksize=32))
+
+
+GMAIL_SKIP_LABELS = frozenset(("DRAFT", "SPAM", "TRASH"))
+
+
+def gmail_history_message_ids(
+    service, user_id: str, start_history_id: str
+) -> Tuple[list, str]:
+    """Ids of messages added since ``start_history_id`` and the latest historyId.
+
+    Drafts, spam and trash are left out, as the search in the full scan
+    would. Raises HttpError (404) when the start id is too old for Gmail
+    to replay.
+    """
+    ids: Dict[str, None] = {}
+    page_token = None
+    while True:
+        resp = (
+            service.users()
+            .history()
+            .list(
+                userId=user_id,
+                startHistoryId=start_history_id,
+                historyTypes=["messageAdded"],
+                pageToken=page_token,
+                maxResults=GMAIL_LIST_PAGE_SIZE,
+            )
+            .execute(num_retries=GMAIL_NUM_RETRIES)
+        )
+        for record in resp.get("history", []):
+            for added in record.get("messagesAdded", []):
+                message = added["message"]
+                if GMAIL_SKIP_LABELS.isdisjoint(message.get("labelIds", ())):
+                    ids[message["id"]] = None
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            return list(ids), resp.get("historyId", start_history_id)
+
+
+def gmail_search_ids(service, user_id: str, query: str) -> set:
+    """Ids of all messages matching a Gmail search ``query``."""
+    ids = set()
+    page_token = None
     while True:
         resp = (
             service.users()
@@ -291,85 +1052,240 @@ def sync_gmail_expenses(conn, creds: "Credentials", days: int = 60) -> int:
             .list(
                 userId=user_id,
                 q=query,
-                pageToken=next_page_token,
-                maxResults=50,
+                pageToken=page_token,
+                maxResults=GMAIL_LIST_PAGE_SIZE,
             )
-            .execute()
+            .execute(num_retries=GMAIL_NUM_RETRIES)
         )
-        msgs = resp.get("messages", [])
-        if not msgs:
-            break
-
-        for m in msgs:
-            full = (
-                service.users()
-                .messages()
-                .get(userId=user_id, id=m["id"], format="full")
-                .execute()
-            )
-            payload = full.get("payload", {})
-            headers = payload.get("headers", [])
+        ids.update(m["id"] for m in resp.get("messages", []))
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            return ids
 
-            subject = next(
-                (h["value"] for h in headers if h["name"].lower() == "subject"),
-                "",
-            )
-            from_ = next(
-                (h["value"] for h in headers if h["name"].lower() == "from"), ""
+
+def iter_gmail_sync(
+    conn,
+    creds: "Credentials",
+    days: int = 60,
+    history_id: Optional[str] = None,
+    since: Optional[int] = None,
+) -> Iterator[Tuple[int, int]]:
+    """Fetch new Gmail messages and insert as expenses, reporting progress.
+
+    Yields ``(processed, added)`` after each page of message ids: ids looked
+    at so far and expenses found so far. The last pair is yielded after the
+    final insert, with ``added`` the number of rows actually inserted.
+
+    With the ``history_id`` and start time (``since``, epoch seconds) of the
+    previous sync only messages added since then that also match the Gmail
+    search are looked at; otherwise (or if Gmail no longer has that history)
+    the last ``days`` days are scanned. The latest historyId and this sync's
+    start time are stored in the same transaction as the final insert.
+    """
+    with gmail_http(creds) as http:
+        service = build_from_document(gmail_discovery_doc(), http=http)
+        yield from _iter_gmail_sync(conn, service, creds, days, history_id, since)
+
+
+def _iter_gmail_sync(
+    conn,
+    service,
+    creds: "Credentials",
+    days: int,
+    history_id: Optional[str],
+    since: Optional[int],
+) -> Iterator[Tuple[int, int]]:
+    started = int(time.time())
+    user_id = "me"
+    added = 0
+    processed = 0
+    pending = []
+
+    def process(ids: list, from_history: bool):
+        nonlocal added, processed
+        processed += len(ids)
+        # messages synced on an earlier run are not fetched again
+        known = known_gmail_ids(conn, ids)
+        new_ids = [i for i in ids if i not in known]
+
+        # headers + snippet first; the full body only for likely receipts
+        # whose amount wasn't in the subject or snippet
+        needs_body = []
+        # history ids include messages deleted since (e.g. superseded
+        # drafts); those are skipped rather than failing the sync
+        for meta in fetch_gmail_messages(
+            service, user_id, new_ids, metadata_only=True, skip_missing=from_history
+        ):
+            subject = gmail_headers(meta.get("payload", {})).get("subject", "")
+            row = parse_gmail_message(meta)
+            if row is not None:
+                pending.append(row)
+            elif RECEIPT_SUBJECT_REGEX.search(subject):
+                needs_body.append(meta["id"])
+        fulls = fetch_gmail_messages(
+            service, user_id, needs_body, skip_missing=from_history
+        )
+        pending.extend(row for row in parse_gmail_messages(fulls) if row is not None)
+
+        # one executemany + commit per GMAIL_INSERT_CHUNK rows
+        if len(pending) >= GMAIL_INSERT_CHUNK:
+            added += store_gmail_expenses(conn, pending)
+            pending.clear()
+
+    new_history_id = None
+    if history_id and since:
+        try:
+            ids, new_history_id = gmail_history_message_ids(
+                service, user_id, history_id
             )
-            date_raw = next(
-                (h["value"] for h in headers if h["name"].lower() == "date"), ""
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            new_history_id = None  # history expired: fall back to a full scan
+        else:
+            if ids:
+                # history isn't filtered by the search query: keep the ids
+                # Gmail's own search (which also matches bodies) returns
+                query = f"after:{since - GMAIL_SINCE_MARGIN} {GMAIL_QUERY}"
+                matching = gmail_search_ids(service, user_id, query)
+                ids = [i for i in ids if i in matching]
+            for start in range(0, len(ids), GMAIL_LIST_PAGE_SIZE):
+                process(ids[start : start + GMAIL_LIST_PAGE_SIZE], from_history=True)
+                yield processed, added + len(pending)
+
+    if new_history_id is None:
+        # taken before listing so nothing arriving mid-scan is skipped later
+        new_history_id = (
+            service.users()
+            .getProfile(userId=user_id)
+            .execute(num_retries=GMAIL_NUM_RETRIES)["historyId"]
+        )
+        query = f"newer_than:{days}d {GMAIL_QUERY}"
+
+        def list_page(page_token: Optional[str]) -> Dict[str, Any]:
+            # may run on the prefetch thread, which needs its own transport
+            with gmail_http(creds) as http:
+                return (
+                    service.users()
+                    .messages()
+                    .list(
+                        userId=user_id,
+                        q=query,
+                        pageToken=page_token,
+                        maxResults=GMAIL_LIST_PAGE_SIZE,
+                    )
+                    .execute(http=http, num_retries=GMAIL_NUM_RETRIES)
+                )
+
+        # list page N+1 while page N is probed, fetched and parsed; one
+        # page in flight at a time keeps us well under per-user rate limits
+        prefetch = gmail_prefetch_pool()
+        resp = list_page(None)
+        while True:
+            next_page_token = resp.get("nextPageToken")
+            next_page = (
+                prefetch.submit(list_page, next_page_token)
+                if next_page_token
+                else None
             )
+            msgs = resp.get("messages", [])
+            if msgs:
+                process([m["id"] for m in msgs], from_history=False)
+                yield processed, added + len(pending)
+            if next_page is None:
+                break
+            resp = next_page.result()
+
+    with transaction(conn):
+        if pending:
+            added += store_gmail_expenses(conn, pending)
+        set_setting(conn, "gmail_history_id", str(new_history_id), commit=False)
+        set_setting(conn, "gmail_synced_at", str(started), commit=False)
+    yield processed, added
+
+
+def gmail_sync_state(
+    conn,
+) -> Tuple[Optional["Credentials"], Optional[str], Optional[int]]:
+    """Credentials, stored historyId and last sync time, from one query."""
+    settings = get_settings(
+        conn, ("gmail_token", "gmail_history_id", "gmail_synced_at")
+    )
+    creds = gmail_credentials_from_token(conn, settings.get("gmail_token"))
+    synced_at = settings.get("gmail_synced_at")
+    return (
+        creds,
+        settings.get("gmail_history_id"),
+        int(synced_at) if synced_at else None,
+    )
 
-            # parse date
-            try:
-                dt_obj = parsedate_to_datetime(date_raw)
-                date_str = dt_obj.date().isoformat()
-            except Exception:
-                date_str = dt.date.today().isoformat()
-
-            body = ""
-            if "parts" in payload:
-                for part in payload["parts"]:
-                    if part.get("mimeType") == "text/plain":
-                        data = part.get("body", {}).get("data")
-                        if data:
-                            body = base64.urlsafe_b64decode(
-                                data.encode("utf-8")
-                            ).decode("utf-8", errors="ignore")
-                            break
-            else:
-                data = payload.get("body", {}).get("data")
-                if data:
-                    body = base64.urlsafe_b64decode(data.encode("utf-8")).decode(
-                        "utf-8", errors="ignore"
-                    )
 
-            amount = parse_amount(subject + "\n" + body)
-            if amount is None:
-                continue
+def sync_gmail_expenses(
+    conn,
+    creds: "Credentials",
+    days: int = 60,
+    history_id: Optional[str] = None,
+    since: Optional[int] = None,
+) -> int:
+    """Run a whole Gmail sync (see iter_gmail_sync). Returns new count."""
+    added = 0
+    for _, added in iter_gmail_sync(conn, creds, days, history_id, since):
+        pass
+    return added
 
-            merchant = from_.split("<")[0].strip() or from_
-            description = subject
-            raw = json.dumps({"subject": subject, "from": from_})[:1000]
 
-            store_expense(conn, "gmail", date_str, merchant, description, amount, raw)
-            added += 1
+def _log_sync_failure(task: "asyncio.Future"):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Gmail sync failed", exc_info=task.exception())
 
-        next_page_token = resp.get("nextPageToken")
-        if not next_page_token:
-            break
 
-    return added
+async def stream_gmail_sync(
+    creds: "Credentials", history_id: Optional[str], since: Optional[int]
+) -> AsyncIterator[bytes]:
+    """NDJSON progress lines for a Gmail sync running in a worker thread.
+
+    The whole sync stays on one thread (its httplib2 transport is not
+    thread-safe) with its own pooled connection, and keeps running if the
+    client goes away.
+    """
+    loop = asyncio.get_running_loop()
+    updates: asyncio.Queue = asyncio.Queue()
+
+    def run():
+        try:
+            with db_pool.connection() as conn:
+                for processed, added in iter_gmail_sync(
+                    conn, creds, 60, history_id, since
+                ):
+                    loop.call_soon_threadsafe(
+                        updates.put_nowait, {"processed": processed, "added": added}
+                    )
+        finally:
+            loop.call_soon_threadsafe(updates.put_nowait, None)
+
+    task = asyncio.ensure_future(run_in_threadpool(run))
+    reported = False
+    try:
+        while True:
+            update = await updates.get()
+            if update is None:
+                break
+            yield orjson.dumps(update) + b"\n"
+        try:
+            await task
+        except Exception as e:
+            yield orjson.dumps({"error": str(e)}) + b"\n"
+        reported = True
+    finally:
+        # the client went away first: nobody else will see a failure
+        if not reported:
+            task.add_done_callback(_log_sync_failure)
 
 # ---------------- HTML / UI ROUTES ----------------
 
 
-@app.get("/", response_class=HTMLResponse)
-def index():
-    # Professional-ish dashboard UI
-    return HTMLResponse(
-        f"""
+# Professional-ish dashboard UI
+INDEX_HTML = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -380,11 +1296,11 @@ def index():
   <link rel="manifest" href="/manifest.webmanifest" />
   <script src="https://cdn.tailwindcss.com"></script>
   <script>
-    if ("serviceWorker" in navigator) {{
-      window.addEventListener("load", () => {{
+    if ("serviceWorker" in navigator) {
+      window.addEventListener("load", () => {
         navigator.serviceWorker.register("/sw.js").catch(console.error);
-      }});
-    }}
+      });
+    }
   </script>
 </head>
 <body class="min-h-screen bg-slate-950 text-slate-100">
@@ -554,7 +1470,7 @@ def index():
           </p>
           <textarea id="gmailConfig" rows="5"
                     class="w-full px-3 py-2 rounded-xl bg-slate-950 border border-slate-700 text-[11px] font-mono"
-                    placeholder='{{"installed":{{"client_id":"...","client_secret":"...","redirect_uris":["http://localhost"]}}}}'></textarea>
+                    placeholder='{"installed":{"client_id":"...","client_secret":"...","redirect_uris":["http://localhost"]}}'></textarea>
           <button id="btnSaveSettings"
                   class="mt-2 px-3 py-2 rounded-xl bg-slate-800 text-slate-100 text-xs border border-slate-600 hover:bg-slate-700">
             Save Gmail config
@@ -568,149 +1484,166 @@ def index():
   </div>
 
 <script>
-const fmt = (n) => "₹" + (n || 0).toLocaleString("en-IN", {{minimumFractionDigits: 2, maximumFractionDigits: 2}});
+const fmt = (n) => "₹" + (n || 0).toLocaleString("en-IN", {minimumFractionDigits: 2, maximumFractionDigits: 2});
 
-async function api(path, options={{}}) {{
-  const res = await fetch(path, Object.assign({{headers: {{"Content-Type":"application/json"}}}}, options));
+async function api(path, options={}) {
+  const res = await fetch(path, Object.assign({headers: {"Content-Type":"application/json"}}, options));
   if (!res.ok) throw new Error(await res.text());
   return res.json();
-}}
+}
 
-async function loadState() {{
+async function loadState() {
   const days = Number(document.getElementById("days").value) || 60;
   const source = document.getElementById("sourceFilter").value;
-  const data = await api(`/api/state?days=${{days}}&source=${{encodeURIComponent(source)}}`);
+  const data = await api(`/api/state?days=${days}&source=${encodeURIComponent(source)}`);
 
   const kpiRow = document.getElementById("kpiRow");
   const total = data.summary.total || 0;
   document.getElementById("kpiTotal").textContent = fmt(total);
-  document.getElementById("kpiCount").textContent = `${{data.summary.expenses.length}} records`;
+  document.getElementById("kpiCount").textContent = `${data.summary.expenses.length} records`;
 
-  const months = Object.entries(data.summary.by_month || {{}}).sort((a,b)=>a[0].localeCompare(b[0]));
-  if (months.length) {{
+  const months = Object.entries(data.summary.by_month || {}).sort((a,b)=>a[0].localeCompare(b[0]));
+  if (months.length) {
     const [m, amt] = months[months.length-1];
     document.getElementById("kpiMonthTotal").textContent = fmt(amt);
     document.getElementById("kpiMonthLabel").textContent = m;
-  }} else {{
+  } else {
     document.getElementById("kpiMonthTotal").textContent = fmt(0);
     document.getElementById("kpiMonthLabel").textContent = "-";
-  }}
+  }
 
   const insightsList = document.getElementById("insightsList");
   insightsList.innerHTML = "";
-  (data.insights || []).forEach(t => {{
+  (data.insights || []).forEach(t => {
     const li = document.createElement("li");
     li.textContent = "• " + t;
     insightsList.appendChild(li);
-  }});
-  if (!data.insights || !data.insights.length) {{
+  });
+  if (!data.insights || !data.insights.length) {
     const li = document.createElement("li");
     li.textContent = "No insights yet.";
     insightsList.appendChild(li);
-  }}
+  }
   kpiRow.hidden = false;
 
   const tbody = document.getElementById("expenseBody");
   tbody.innerHTML = "";
-  if (!data.summary.expenses.length) {{
+  if (!data.summary.expenses.length) {
     document.getElementById("noExpenses").hidden = false;
-  }} else {{
+  } else {
     document.getElementById("noExpenses").hidden = true;
-    data.summary.expenses.forEach(e => {{
+    data.summary.expenses.forEach(e => {
       const tr = document.createElement("tr");
       tr.className = "hover:bg-slate-950/60";
       tr.innerHTML = `
-        <td class="py-2 px-3 whitespace-nowrap">${{e.date}}</td>
-        <td class="py-2 px-3 text-right whitespace-nowrap">${{fmt(e.amount)}}</td>
-        <td class="py-2 px-3 whitespace-nowrap text-[10px] text-slate-400">${{e.source}}</td>
-        <td class="py-2 px-3 whitespace-nowrap max-w-[120px] truncate">${{e.merchant}}</td>
-        <td class="py-2 px-3 whitespace-nowrap max-w-[220px] truncate">${{e.description}}</td>`;
+        <td class="py-2 px-3 whitespace-nowrap">${e.date}</td>
+        <td class="py-2 px-3 text-right whitespace-nowrap">${fmt(e.amount)}</td>
+        <td class="py-2 px-3 whitespace-nowrap text-[10px] text-slate-400">${e.source}</td>
+        <td class="py-2 px-3 whitespace-nowrap max-w-[120px] truncate">${e.merchant}</td>
+        <td class="py-2 px-3 whitespace-nowrap max-w-[220px] truncate">${e.description}</td>`;
       tbody.appendChild(tr);
-    }});
-  }}
+    });
+  }
 
   const todoList = document.getElementById("todoList");
   todoList.innerHTML = "";
-  data.todos.forEach(t => {{
+  data.todos.forEach(t => {
     const li = document.createElement("li");
     li.className = "flex items-center gap-2";
     const cb = document.createElement("input");
     cb.type = "checkbox";
     cb.checked = !!t.done;
-    cb.onchange = async () => {{
-      await api("/api/todos/toggle", {{method:"POST", body:JSON.stringify({{id: t.id}})}});
+    cb.onchange = async () => {
+      await api("/api/todos/toggle", {method:"POST", body:JSON.stringify({id: t.id})});
       loadState();
-    }};
+    };
     const span = document.createElement("span");
     span.textContent = t.text;
     if (t.done) span.className = "line-through text-slate-500";
     const del = document.createElement("button");
     del.textContent = "×";
     del.className = "text-[10px] text-slate-500 hover:text-red-400";
-    del.onclick = async () => {{
-      await api("/api/todos/delete", {{method:"POST", body:JSON.stringify({{id:t.id}})}});
+    del.onclick = async () => {
+      await api("/api/todos/delete", {method:"POST", body:JSON.stringify({id:t.id})});
       loadState();
-    }};
+    };
     li.appendChild(cb);
     li.appendChild(span);
     li.appendChild(del);
     todoList.appendChild(li);
-  }});
+  });
 
   document.getElementById("gmailConfig").value = data.gmail_config || "";
   document.getElementById("gmailStatus").textContent = data.gmail_status;
-}}
+}
 
-async function addExpense() {{
+async function addExpense() {
   const source = document.getElementById("newSource").value;
   const date = document.getElementById("newDate").value || new Date().toISOString().slice(0,10);
   const amt = parseFloat(document.getElementById("newAmount").value || "0");
   const merch = document.getElementById("newMerchant").value;
   const desc = document.getElementById("newDescription").value;
-  if (!amt) {{
+  if (!amt) {
     alert("Amount is required");
     return;
-  }}
-  await api("/api/expenses/add", {{
+  }
+  await api("/api/expenses/add", {
     method:"POST",
-    body: JSON.stringify({{source, date, amount:amt, merchant:merch, description:desc}})
-  }});
+    body: JSON.stringify({source, date, amount:amt, merchant:merch, description:desc})
+  });
   document.getElementById("newAmount").value = "";
   document.getElementById("newDescription").value = "";
   await loadState();
-}}
+}
 
-async function addTodo() {{
+async function addTodo() {
   const txt = document.getElementById("todoText").value.trim();
   if (!txt) return;
-  await api("/api/todos/add", {{method:"POST", body:JSON.stringify({{text:txt}})}});
+  await api("/api/todos/add", {method:"POST", body:JSON.stringify({text:txt})});
   document.getElementById("todoText").value = "";
   await loadState();
-}}
+}
 
-async function saveSettings() {{
+async function saveSettings() {
   const cfg = document.getElementById("gmailConfig").value.trim();
-  await api("/api/settings/gmail", {{method:"POST", body:JSON.stringify({{client_config_json: cfg}})}});
+  await api("/api/settings/gmail", {method:"POST", body:JSON.stringify({client_config_json: cfg})});
   alert("Saved Gmail config. Now click 'Connect Gmail'.");
   await loadState();
-}}
+}
 
-function connectGmail() {{
+function connectGmail() {
   window.location.href = "/api/gmail/start";
-}}
+}
 
-async function syncGmail() {{
+async function syncGmail() {
   const status = document.getElementById("status");
   status.textContent = "Syncing from Gmail…";
-  try {{
-    const res = await api("/api/gmail/sync", {{method:"POST"}});
-    status.textContent = `Synced ${{res.added}} expenses from Gmail.`;
+  try {
+    const res = await fetch("/api/gmail/sync", {method:"POST"});
+    if (!res.ok) throw new Error(await res.text());
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buf = "", last = null;
+    for (;;) {
+      const {done, value} = await reader.read();
+      if (done) break;
+      buf += decoder.decode(value, {stream: true});
+      const lines = buf.split("\\n");
+      buf = lines.pop();
+      for (const line of lines) {
+        if (!line) continue;
+        last = JSON.parse(line);
+        if (last.error) throw new Error(last.error);
+        status.textContent = `Syncing from Gmail… ${last.processed} messages checked, ${last.added} expenses found.`;
+      }
+    }
+    status.textContent = `Synced ${last ? last.added : 0} expenses from Gmail.`;
     await loadState();
-  }} catch (e) {{
+  } catch (e) {
     alert("Gmail sync error: " + e.message);
     status.textContent = "Gmail sync failed.";
-  }}
-}}
+  }
+}
 
 document.getElementById("btnLoad").onclick = loadState;
 document.getElementById("btnAddExpense").onclick = addExpense;
@@ -723,31 +1656,21 @@ loadState().catch(console.error);
 </script>
 </body>
 </html>
-        """
-    )
-
-@app.get("/manifest.webmanifest", response_class=PlainTextResponse)
-def manifest():
-    return PlainTextResponse(
-        json.dumps(
-            {
-                "name": "Expense & Todo Tracker",
-                "short_name": "Expenses",
-                "start_url": "/",
-                "display": "standalone",
-                "background_color": "#020617",
-                "theme_color": "#020617",
-                "icons": [],
-            }
-        ),
-        media_type="application/manifest+json",
-    )
-
+"""
+
+MANIFEST_JSON = json.dumps(
+    {
+        "name": "Expense & Todo Tracker",
+        "short_name": "Expenses",
+        "start_url": "/",
+        "display": "standalone",
+        "background_color": "#020617",
+        "theme_color": "#020617",
+        "icons": [],
+    }
+)
 
-@app.get("/sw.js", response_class=PlainTextResponse)
-def service_worker():
-    return PlainTextResponse(
-        """
+SERVICE_WORKER_JS = """
 self.addEventListener('install', event => {
   self.skipWaiting();
 });
@@ -757,133 +1680,250 @@ self.addEventListener('activate', event => {
 self.addEventListener('fetch', event => {
   // passthrough network – could add caching here
 });
-        """,
-        media_type="application/javascript",
+"""
+
+STATIC_CACHE_CONTROL = "public, max-age=3600"
+
+
+def _static_asset(text: str) -> Tuple[bytes, str]:
+    """Encode a constant asset once and derive its ETag from the bytes."""
+    body = text.encode("utf-8")
+    return body, '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+
+
+INDEX_BYTES, INDEX_ETAG = _static_asset(INDEX_HTML)
+MANIFEST_BYTES, MANIFEST_ETAG = _static_asset(MANIFEST_JSON)
+SERVICE_WORKER_BYTES, SERVICE_WORKER_ETAG = _static_asset(SERVICE_WORKER_JS)
+
+
+def static_response(
+    request: Request, body: bytes, etag: str, media_type: str
+) -> Response:
+    headers = {"ETag": etag, "Cache-Control": STATIC_CACHE_CONTROL}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+@app.get("/", response_class=HTMLResponse)
+def index(request: Request):
+    return static_response(request, INDEX_BYTES, INDEX_ETAG, "text/html")
+
+
+@app.get("/manifest.webmanifest", response_class=PlainTextResponse)
+def manifest(request: Request):
+    return static_response(
+        request, MANIFEST_BYTES, MANIFEST_ETAG, "application/manifest+json"
     )
 
+
+@app.get("/sw.js", response_class=PlainTextResponse)
+def service_worker(request: Request):
+    return static_response(
+        request, SERVICE_WORKER_BYTES, SERVICE_WORKER_ETAG, "application/javascript"
+    )
+
+# ---------------- REQUEST SCHEMAS ----------------
+
+
+class ExpenseIn(msgspec.Struct):
+    amount: Optional[float] = None
+    source: str = "manual"
+    date: Optional[str] = None
+    merchant: str = ""
+    description: str = ""
+
+
+class TodoIn(msgspec.Struct):
+    text: Optional[str] = None
+
+
+class TodoRef(msgspec.Struct):
+    id: int
+
+
+class GmailSettingsIn(msgspec.Struct):
+    client_config_json: Optional[str] = None
+
+
+def json_body(type_):
+    """Dependency that decodes + validates the request body in one pass."""
+
+    async def dependency(request: Request):
+        try:
+            return msgspec.json.decode(await request.body(), type=type_, strict=False)
+        except msgspec.DecodeError as e:
+            raise HTTPException(400, str(e))
+
+    return dependency
+
 # ---------------- JSON API ROUTES ----------------
 
 
-@app.get("/api/state", response_class=JSONResponse)
-def api_state(days: int = 60, source: str = "all"):
-    conn = get_db()
-    summary = summarize_expenses(conn, days=days, source=source)
+@app.get("/api/state", response_class=ORJSONResponse)
+def api_state(
+    days: int = 60, source: str = "all", conn: sqlite3.Connection = Depends(get_db_dep)
+):
+    # every read below sees the same WAL snapshot
+    with transaction(conn):
+        summary = summarize_expenses(conn, days=days, source=source)
+        todos = get_todos(conn)
+        settings = get_settings(conn, ("gmail_client_config", "gmail_token"))
     insights = build_insights(summary)
-    todos = get_todos(conn)
-    cfg = get_gmail_client_config(conn)
-    gmail_status = (
-        "Gmail support not installed."
-        if not HAS_GMAIL
-        else ("Gmail connected." if get_gmail_credentials(conn) else "Gmail not connected.")
-    )
+    cfg = parse_gmail_client_config(settings.get("gmail_client_config"))
+    if not HAS_GMAIL:
+        gmail_status = "Gmail support not installed."
+    elif gmail_credentials_from_token(conn, settings.get("gmail_token")):
+        gmail_status = "Gmail connected."
+    else:
+        gmail_status = "Gmail not connected."
     return {
         "summary": summary,
         "insights": insights,
         "todos": todos,
-        "gmail_config": json.dumps(cfg) if cfg else "",
+        "gmail_config": orjson.dumps(cfg).decode() if cfg else "",
         "gmail_status": gmail_status,
     }
 
 
-@app.post("/api/expenses/add", response_class=JSONResponse)
-async def api_add_expense(request: Request):
-    data = await request.json()
-    source = data.get("source", "manual")
-    date = data.get("date") or dt.date.today().isoformat()
-    amount = float(data.get("amount") or 0)
-    if amount <= 0:
-        raise HTTPException(400, "Amount must be > 0")
-    merchant = data.get("merchant", "")
-    description = data.get("description", "")
+@app.post("/api/expenses/add", response_class=ORJSONResponse)
+async def api_add_expense(
+    payload: Union[ExpenseIn, List[ExpenseIn]] = Depends(
+        json_body(Union[ExpenseIn, List[ExpenseIn]])
+    ),
+    conn: sqlite3.Connection = Depends(get_db_dep),
+):
+    # a single expense object, or a list of them imported in one transaction
+    items = payload if isinstance(payload, list) else [payload]
+    if not items:
+        raise HTTPException(400, "No expenses given")
+    today = dt.date.today().isoformat()
+    rows = []
+    for item in items:
+        if not item.amount or item.amount <= 0:
+            raise HTTPException(400, "Amount must be > 0")
+        rows.append(
+            (
+                item.source,
+                item.date or today,
+                item.merchant,
+                item.description,
+                item.amount,
+                item.description,
+            )
+        )
 
-    conn = get_db()
-    store_expense(conn, source, date, merchant, description, amount, description)
-    return {"ok": True}
+    await run_in_threadpool(store_expenses, conn, rows)
+    return {"ok": True, "inserted": len(rows)}
 
 
-@app.post("/api/todos/add", response_class=JSONResponse)
-async def api_add_todo(request: Request):
-    data = await request.json()
-    text = (data.get("text") or "").strip()
+@app.post("/api/todos/add", response_class=ORJSONResponse)
+async def api_add_todo(
+    payload: TodoIn = Depends(json_body(TodoIn)),
+    conn: sqlite3.Connection = Depends(get_db_dep),
+):
+    text = (payload.text or "").strip()
     if not text:
         raise HTTPException(400, "Text required")
-    conn = get_db()
-    conn.execute("INSERT INTO todos(text) VALUES (?)", (text,))
-    conn.commit()
+    await run_in_threadpool(add_todo, conn, text)
     return {"ok": True}
 
 
-@app.post("/api/todos/toggle", response_class=JSONResponse)
-async def api_toggle_todo(request: Request):
-    data = await request.json()
-    todo_id = int(data.get("id"))
-    conn = get_db()
-    row = conn.execute("SELECT done FROM todos WHERE id=?", (todo_id,)).fetchone()
-    if not row:
+@app.post("/api/todos/toggle", response_class=ORJSONResponse)
+async def api_toggle_todo(
+    payload: TodoRef = Depends(json_body(TodoRef)),
+    conn: sqlite3.Connection = Depends(get_db_dep),
+):
+    if not await run_in_threadpool(toggle_todo, conn, payload.id):
         raise HTTPException(404, "Todo not found")
-    new_done = 0 if row["done"] else 1
-    conn.execute("UPDATE todos SET done=? WHERE id=?", (new_done, todo_id))
-    conn.commit()
     return {"ok": True}
 
 
-@app.post("/api/todos/delete", response_class=JSONResponse)
-async def api_delete_todo(request: Request):
-    data = await request.json()
-    todo_id = int(data.get("id"))
-    conn = get_db()
-    conn.execute("DELETE FROM todos WHERE id=?", (todo_id,))
-    conn.commit()
+@app.post("/api/todos/delete", response_class=ORJSONResponse)
+async def api_delete_todo(
+    payload: TodoRef = Depends(json_body(TodoRef)),
+    conn: sqlite3.Connection = Depends(get_db_dep),
+):
+    await run_in_threadpool(delete_todo, conn, payload.id)
     return {"ok": True}
 
 
-@app.post("/api/settings/gmail", response_class=JSONResponse)
-async def api_save_gmail_settings(request: Request):
-    data = await request.json()
-    cfg = (data.get("client_config_json") or "").strip()
-    conn = get_db()
+@app.post("/api/settings/gmail", response_class=ORJSONResponse)
+async def api_save_gmail_settings(
+    payload: GmailSettingsIn = Depends(json_body(GmailSettingsIn)),
+    conn: sqlite3.Connection = Depends(get_db_dep),
+):
+    cfg = (payload.client_config_json or "").strip()
     if not cfg:
-        set_setting(conn, "gmail_client_config", "")
+        await run_in_threadpool(set_gmail_client_config, conn, None)
         return {"ok": True}
     try:
-        parsed = json.loads(cfg)
-    except json.JSONDecodeError:
+        parsed = orjson.loads(cfg)
+    except orjson.JSONDecodeError:
         raise HTTPException(400, "Invalid JSON")
-    set_setting(conn, "gmail_client_config", json.dumps(parsed))
+    await run_in_threadpool(set_gmail_client_config, conn, parsed)
     return {"ok": True}
 
 # ---------------- GMAIL ROUTES ----------------
 
 
+class SharedHTMLResponse(HTMLResponse):
+    """HTMLResponse built once and returned for many requests."""
+
+    async def __call__(self, scope, receive, send):
+        # middleware edits the start message's header list in place
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": list(self.raw_headers),
+            }
+        )
+        await send({"type": "http.response.body", "body": self.body})
+
+
+# the missing-libraries page only changes on a restart: let the browser
+# reuse it briefly
+GMAIL_START_CACHE_HEADERS = {"Cache-Control": "private, max-age=60"}
+
+HTML_NO_GMAIL = SharedHTMLResponse(
+    "<h3>Gmail support is not installed on this server.</h3>"
+    "<p>Install google-api-python-client, google-auth-httplib2, google-auth-oauthlib and restart.</p>",
+    status_code=500,
+    headers=GMAIL_START_CACHE_HEADERS,
+)
+HTML_NO_CFG = SharedHTMLResponse(
+    "<h3>No Gmail client config saved.</h3>"
+    "<p>Go back → Settings → paste OAuth client JSON → Save Gmail config.</p>",
+    status_code=400,
+    # must not be cached: it goes away as soon as the config is saved
+    headers={"Cache-Control": "no-store"},
+)
+HTML_STATE_EXPIRED = SharedHTMLResponse(
+    "Auth state expired. Try again.", status_code=400
+)
+HTML_CONNECTED = SharedHTMLResponse(
+    "<h1>Gmail connected ✅</h1><p>You can close this tab and return to the app.</p>"
+)
+
+if HAS_GMAIL:
+    _FLOW_FROM_CFG = functools.partial(Flow.from_client_config, scopes=GMAIL_SCOPES)
+
+
 @app.get("/api/gmail/start")
-def api_gmail_start():
+def api_gmail_start(conn: sqlite3.Connection = Depends(get_db_dep)):
     # 1) Check libs
     if not HAS_GMAIL:
-        return HTMLResponse(
-            "<h3>Gmail support is not installed on this server.</h3>"
-            "<p>Install google-api-python-client, google-auth-httplib2, google-auth-oauthlib and restart.</p>",
-            status_code=500,
-        )
+        return HTML_NO_GMAIL
 
-    conn = get_db()
     cfg = get_gmail_client_config(conn)
 
     # 2) Check config
     if not cfg:
-        return HTMLResponse(
-            "<h3>No Gmail client config saved.</h3>"
-            "<p>Go back → Settings → paste OAuth client JSON → Save Gmail config.</p>",
-            status_code=400,
-        )
-
-    redirect_uri = f"{BASE_URL}/api/gmail/callback"
+        return HTML_NO_CFG
 
     try:
-        flow = Flow.from_client_config(
-            cfg,
-            scopes=GMAIL_SCOPES,
-            redirect_uri=redirect_uri,
-        )
+        flow = _FLOW_FROM_CFG(cfg, redirect_uri=GMAIL_REDIRECT_URI)
         # FIX: no include_granted_scopes=True (that caused the 400)
         auth_url, state = flow.authorization_url(
             access_type="offline",
@@ -891,37 +1931,65 @@ def api_gmail_start():
         )
     except Exception as e:
         return HTMLResponse(
-            f"<h3>Error building Google auth URL</h3><pre>{e}</pre>",
+            f"<h3>Error building Google auth URL</h3><pre>{html.escape(str(e))}</pre>",
             status_code=500,
         )
 
-    OAUTH_FLOWS[state] = flow
+    OAUTH_STATES.set(
+        state,
+        {"redirect_uri": GMAIL_REDIRECT_URI, "code_verifier": flow.code_verifier},
+    )
     return RedirectResponse(auth_url)
 
 
 @app.get("/api/gmail/callback")
-def api_gmail_callback(state: str, code: str):
-    if state not in OAUTH_FLOWS:
-        return HTMLResponse("Auth state expired. Try again.", status_code=400)
-
-    flow = OAUTH_FLOWS.pop(state)
+def api_gmail_callback(
+    state: str, code: str, conn: sqlite3.Connection = Depends(get_db_dep)
+):
+    pending = OAUTH_STATES.pop(state)
+    if pending is None:
+        return HTML_STATE_EXPIRED
+    cfg = get_gmail_client_config(conn)
+    if not cfg:
+        return HTML_NO_CFG
+
+    # rebuild the flow started in api_gmail_start, possibly on another worker
+    flow = _FLOW_FROM_CFG(
+        cfg,
+        redirect_uri=pending["redirect_uri"],
+        state=state,
+        code_verifier=pending["code_verifier"],
+    )
     flow.fetch_token(code=code)
     creds = flow.credentials
 
-    conn = get_db()
-    set_setting(conn, "gmail_token", creds.to_json())
-    return HTMLResponse(
-        "<h1>Gmail connected ✅</h1><p>You can close this tab and return to the app.</p>"
-    )
+    with transaction(conn):
+        set_setting(conn, "gmail_token", creds.to_json(), commit=False)
+        # a (possibly different) account: start over with a full scan
+        set_setting(conn, "gmail_history_id", "", commit=False)
+    return HTML_CONNECTED
 
 
-@app.post("/api/gmail/sync", response_class=JSONResponse)
-def api_gmail_sync():
+@app.post("/api/gmail/sync", response_class=ORJSONResponse)
+async def api_gmail_sync(
+    stream: bool = True,
+    # released when this returns, not after the streamed sync (which
+    # checks out its own connection) has finished
+    conn: sqlite3.Connection = Depends(get_db_dep, scope="function"),
+):
     if not HAS_GMAIL:
         raise HTTPException(500, "Gmail libraries not installed on server.")
-    conn = get_db()
-    creds = get_gmail_credentials(conn)
+    # settings reads, token refresh and the Gmail API calls all block
+    creds, history_id, since = await run_in_threadpool(gmail_sync_state, conn)
     if not creds:
         raise HTTPException(400, "Gmail not connected. Save config + Connect first.")
-    added = sync_gmail_expenses(conn, creds, days=60)
+    if stream:
+        # one {"processed", "added"} line per page of messages
+        return StreamingResponse(
+            stream_gmail_sync(creds, history_id, since),
+            media_type="application/x-ndjson",
+        )
+    added = await run_in_threadpool(
+        sync_gmail_expenses, conn, creds, 60, history_id, since
+    )
     return {"added": added}